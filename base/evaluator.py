@@ -1,63 +1,134 @@
-import time
+import copy
+
 import numpy as np
+import torch
 
 from sac.utils import calculate_phase
+from laserhockey import hockey_env as h_env
 
-def evaluate(agent, env, opponent, eval_episodes, quiet=False, action_mapping=None):
-    old_verbose = env.verbose
-    env.verbose = not quiet
 
-    rew_stats = []
-    touch_stats = {}
-    won_stats = {}
-    lost_stats = {}
+def _make_policies(agent, env):
+    # The mode dependent branches are resolved once, so that the step loop only calls the returned policies.
+    # The agent acts on a batch of observations, one per environment.
+    if agent.args.phased:
+        def get_a1(obs):
+            phase = torch.stack([calculate_phase(obs=ob, env=env, info=None, player=1) for ob in obs])
+            return agent.act_batch(obs, phase=phase)
+    else:
+        get_a1 = agent.act_batch
+
+    # The opponent observation is only computed when the opponent acts on it
+    if agent.args.mode in ['defense', 'normal']:
+        def get_a2(e, opponent):
+            return opponent.act(e.obs_agent_two())
+    elif agent.args.mode == 'shooting':
+        zeros = np.zeros(env.num_actions)
+
+        def get_a2(e, opponent):
+            return zeros
+    else:
+        raise ValueError('Unknown training mode. See --help')
+
+    return get_a1, get_a2
 
-    for episode_counter in range(eval_episodes):
-        total_reward = 0
-        ob, info_dict  = env.reset()
-        obs_agent2 = env.obs_agent_two()
 
-        if (env.puck.position[0] < 5 and agent.args.mode == 'defense') or (
-                env.puck.position[0] > 5 and agent.args.mode == 'shooting'
-        ):
+def _reset_next_episode(env, episodes, mode):
+    # Episodes which do not suit the training mode are skipped, the next one is started instead
+    for episode_counter in episodes:
+        ob, info_dict = env.reset()
+        puck_x = env.puck.position[0]
+        if (puck_x < 5 and mode == 'defense') or (puck_x > 5 and mode == 'shooting'):
             continue
+        return episode_counter, ob
+    return None, None
+
+
+def evaluate(agent, env, opponent, eval_episodes, quiet=False, action_mapping=None, n_envs=1):
+    """
+    Evaluates the agent against the opponent, keeping up to n_envs episodes running at the same time.
+    The environments are stepped one after another in this process, only the agent acts on all running
+    environments with a single batched forward pass per step.
+    The additional environments are seeded from env, every environment plays against its own shallow copy
+    of the opponent, so that the state of a stateful opponent (e.g. the phase of BasicOpponent) advances
+    once per step of its environment.
+    """
+    # The given env is always used, even if no episode is played
+    n_copies = max(min(n_envs, eval_episodes), 1) - 1
+    envs = [env] + [h_env.HockeyEnv(keep_mode=env.keep_mode, mode=env.mode) for _ in range(n_copies)]
+    for e, seed in zip(envs[1:], env.np_random.integers(2 ** 31, size=n_copies)):
+        e.seed(int(seed))
+    opponents = [opponent] + [copy.copy(opponent) for _ in range(n_copies)]
+    old_verbose = env.verbose
+    for e in envs:
+        e.verbose = not quiet
+
+    # Per episode stats, only the played (not skipped) episodes are taken into account
+    played = np.zeros(eval_episodes, dtype=bool)
+    rew_stats = np.zeros(eval_episodes)
+    touch_stats = np.zeros(eval_episodes, dtype=bool)
+    won_stats = np.zeros(eval_episodes, dtype=bool)
+    lost_stats = np.zeros(eval_episodes, dtype=bool)
+
+    get_a1, get_a2 = _make_policies(agent, env)
+    mode = agent.args.mode
+    show = agent.args.show
+    n_actions = env.action_space.shape[0] // 2
+    action_buf = np.empty((len(envs), 2 * n_actions), dtype=np.float32)
+
+    episodes = iter(range(eval_episodes))
+    episode_counters = [None] * len(envs)
+    obs = [np.zeros(env.observation_space.shape)] * len(envs)
+    steps = np.zeros(len(envs), dtype=int)
+    total_reward = np.zeros(len(envs))
+    touched = np.zeros(len(envs), dtype=bool)
+
+    def start_episode(i):
+        episode_counter, ob = _reset_next_episode(envs[i], episodes, mode)
+        if episode_counter is None:
+            return False
+        episode_counters[i], obs[i] = episode_counter, ob
+        steps[i], total_reward[i], touched[i] = 0, 0, False
+        return True
+
+    active = [i for i in range(len(envs)) if start_episode(i)]
+    while active:
+        # Finished environments keep their last observation, so that the batch shape stays fixed
+        a1 = get_a1(np.stack(obs))
+
+        still_active = []
+        for i in active:
+            e = envs[i]
+            action_buf[i, :n_actions] = a1[i]
+            action_buf[i, n_actions:] = get_a2(e, opponents[i])
+
+            (obs[i], reward, done, _, _info) = e.step(action_buf[i])
+
+            touched[i] |= _info['reward_touch_puck'] > 0
+            total_reward[i] += reward
+            steps[i] += 1
+
+            if show and i == 0:
+                e.render()
+            if not done and steps[i] < e.max_timesteps:
+                still_active.append(i)
+                continue
+
+            episode_counter = episode_counters[i]
+            played[episode_counter] = True
+            won_stats[episode_counter] = done and e.winner == 1
+            lost_stats[episode_counter] = done and e.winner == -1
+            touch_stats[episode_counter] = touched[i]
+            rew_stats[episode_counter] = total_reward[i]
+            if not quiet:
+                agent.logger.print_episode_info(e.winner, episode_counter, steps[i] - 1, total_reward[i], epsilon=0,
+                                                touched=touch_stats[episode_counter])
+
+            if start_episode(i):
+                still_active.append(i)
+        active = still_active
 
-        touch_stats[episode_counter] = 0
-        won_stats[episode_counter] = 0
-        lost_stats[episode_counter] = 0
-        for step in range(env.max_timesteps):
-            phase = calculate_phase(obs=ob, env=env, info=None, player=1)
-            # SAC act
-            if agent.args.phased:
-                a1 = agent.act(ob, phase=phase)
-            else:
-                a1 = agent.act(ob)
-
-            if agent.args.mode in ['defense', 'normal']:
-                a2 = opponent.act(obs_agent2)
-            elif agent.args.mode == 'shooting':
-                a2 = [0, 0, 0, 0]
-
-            (ob_new, reward, done, _, _info) = env.step(np.hstack([a1, a2]))
-            ob = ob_new
-            obs_agent2 = env.obs_agent_two()
-
-            if _info['reward_touch_puck'] > 0:
-                touch_stats[episode_counter] = 1
-            total_reward += reward
-
-            if agent.args.show:
-                time.sleep(0.01)
-                env.render()
-            if done:
-                won_stats[episode_counter] = 1 if env.winner == 1 else 0
-                lost_stats[episode_counter] = 1 if env.winner == -1 else 0
-                break
-
-        rew_stats.append(total_reward)
-        if not quiet:
-            agent.logger.print_episode_info(env.winner, episode_counter, step, total_reward, epsilon=0,
-                                            touched=touch_stats[episode_counter])
+    rew_stats, touch_stats = rew_stats[played], touch_stats[played]
+    won_stats, lost_stats = won_stats[played], lost_stats[played]
 
     if not quiet:
         # Print evaluation stats
@@ -65,11 +136,13 @@ def evaluate(agent, env, opponent, eval_episodes, quiet=False, action_mapping=No
 
     # Toggle the verbose flag onto the old value
     env.verbose = old_verbose
+    for e in envs[1:]:
+        e.close()
 
     return {
-        'Reward per Game': np.mean(rew_stats).item(),
-        'Touch per Game': np.mean(list(touch_stats.values())).item(),
-        'Won Percentage': np.mean(list(won_stats.values())).item(),
-        'Loss Percentage': np.mean(list(lost_stats.values())).item(),
-        'Draw Percentage': 1 - np.mean(list(won_stats.values())).item() - np.mean(list(lost_stats.values())).item()
+        'Reward per Game': rew_stats.mean().item(),
+        'Touch per Game': touch_stats.mean().item(),
+        'Won Percentage': won_stats.mean().item(),
+        'Loss Percentage': lost_stats.mean().item(),
+        'Draw Percentage': 1 - won_stats.mean().item() - lost_stats.mean().item()
     }
@@ -3,7 +3,7 @@ sys.path.insert(0, '.')
 sys.path.insert(1, '..')
 
 import numpy as np
-from copy import deepcopy
+import torch
 from .segment_tree import SumSegmentTree, MinSegmentTree
 from sac.utils import *
 import os
@@ -20,29 +20,109 @@ class ExperienceReplay:
     """
 
     def __init__(self, max_size=100000):
-        self._transitions = np.asarray([])
+        self._state = None
+        self._action = None
+        self._reward = None
+        self._next_state = None
+        self._done = None
+        self._extras = []
         self._current_idx = 0
         self.size = 0
         self.max_size = max_size
 
+    def _allocate(self, transition):
+        # Storage is allocated lazily, as the state and action dimensions are only known from the first transition
+        state, action, _, next_state, _ = transition[:5]
+        self._state = np.empty((self.max_size, np.asarray(state).size), dtype=np.float32)
+        self._action = np.empty((self.max_size, np.asarray(action).size), dtype=np.float32)
+        self._reward = np.empty((self.max_size,), dtype=np.float32)
+        self._next_state = np.empty((self.max_size, np.asarray(next_state).size), dtype=np.float32)
+        self._done = np.empty((self.max_size,), dtype=np.bool_)
+        # Extra entries of a transition (e.g. phase, next_phase) are stored as additional float columns
+        self._extras = [np.empty((self.max_size, np.asarray(e).size), dtype=np.float32) for e in transition[5:]]
+
+    def __setstate__(self, state):
+        # Buffers pickled before the column layout hold all transitions in one object array of shape
+        # (max_size, n_entries). Its rows are copied into the columns at the same ring buffer positions.
+        transitions = state.pop('_transitions', None)
+        self.__dict__.update(state)
+        if transitions is None:
+            return
+
+        self._state, self._action, self._reward, self._next_state, self._done = None, None, None, None, None
+        self._extras = []
+        if self.size == 0:
+            return
+        self._allocate(tuple(transitions[0]))
+        for column, entries in zip(self._columns(), transitions[:self.size].T):
+            column[:self.size] = np.array(
+                [np.asarray(e, dtype=column.dtype) for e in entries]
+            ).reshape(column[:self.size].shape)
+
+    def _columns(self):
+        return [self._state, self._action, self._reward, self._next_state, self._done] + self._extras
+
+    def _get_transitions(self, indices):
+        return tuple(column[indices] for column in self._columns())
+
     @staticmethod
     def clone_buffer(new_buffer, maxsize):
-        old_transitions = deepcopy(new_buffer._transitions)
         buffer = UniformExperienceReplay(max_size=maxsize)
-        for t in old_transitions:
-            buffer.add_transition(t)
+        if new_buffer._state is None:
+            return buffer
+
+        # Copy the transitions oldest first, split into the two contiguous parts of the ring buffer
+        start = new_buffer._current_idx if new_buffer.size == new_buffer.max_size else 0
+        for lo, hi in ((start, new_buffer.size), (0, start)):
+            buffer._insert_columns([column[lo:hi] for column in new_buffer._columns()])
 
         return buffer
 
+    def _insert_columns(self, columns):
+        """Writes a batch of transitions given column-wise into the ring buffer and returns the written indices."""
+        n = len(columns[0])
+        if n == 0:
+            return np.arange(0)
+        if self._state is None:
+            self._allocate(tuple(column[0] for column in columns))
+
+        # Only the newest max_size transitions survive
+        if n > self.max_size:
+            self._current_idx = (self._current_idx + n - self.max_size) % self.max_size
+            columns = [column[n - self.max_size:] for column in columns]
+            n = self.max_size
+
+        start = self._current_idx
+        first = min(n, self.max_size - start)
+        for column, values in zip(self._columns(), columns):
+            values = np.reshape(values, (n,) + column.shape[1:])
+            column[start:start + first] = values[:first]
+            column[:n - first] = values[first:]
+
+        self.size = min(self.size + n, self.max_size)
+        self._current_idx = (start + n) % self.max_size
+        return (start + np.arange(n)) % self.max_size
+
     def add_transition(self, transitions_new):
-        if self.size == 0:
-            blank_buffer = [np.asarray(transitions_new, dtype=object)] * self.max_size
-            self._transitions = np.asarray(blank_buffer)
+        if self._state is None:
+            self._allocate(transitions_new)
+
+        idx = self._current_idx
+        self._state[idx] = np.ravel(transitions_new[0])
+        self._action[idx] = np.ravel(transitions_new[1])
+        self._reward[idx] = transitions_new[2]
+        self._next_state[idx] = np.ravel(transitions_new[3])
+        self._done[idx] = transitions_new[4]
+        for column, value in zip(self._extras, transitions_new[5:]):
+            column[idx] = np.ravel(value)
 
-        self._transitions[self._current_idx, :] = np.asarray(transitions_new, dtype=object)
         self.size = min(self.size + 1, self.max_size)
         self._current_idx = (self._current_idx + 1) % self.max_size
 
+    def add_transitions_bulk(self, states, actions, rewards, next_states, dones):
+        """Adds a batch of transitions given as arrays with one row per transition."""
+        return self._insert_columns([states, actions, rewards, next_states, dones])
+
     def preload_transitions(self, path):
         for file in os.listdir(path):
             if file.endswith(".npz"):
@@ -51,26 +131,34 @@ class ExperienceReplay:
                 with np.load(fpath, allow_pickle=True) as d:
                     np_data = d['arr_0'].item()
 
-                    if (
-                        # Add a fancy condition
-                        True
-                    ):
-                        transitions = recompute_rewards(np_data, 'Dimitrije_Antic_-_SAC_ЈУГО')
-                        for t in transitions:
-                            tr = (
-                                t[0],
-                                t[1],
-                                float(t[3]),
-                                t[2],
-                                bool(t[4]),
-                            )
-                            self.add_transition(tr)
+                    transitions = recompute_rewards(np_data, 'Dimitrije_Antic_-_SAC_ЈУГО')
+                    if len(transitions) == 0:
+                        continue
+
+                    self.add_transitions_bulk(
+                        states=np.asarray([t[0] for t in transitions], dtype=np.float32),
+                        actions=np.asarray([t[1] for t in transitions], dtype=np.float32),
+                        rewards=np.asarray([t[3] for t in transitions], dtype=np.float32),
+                        next_states=np.asarray([t[2] for t in transitions], dtype=np.float32),
+                        dones=np.asarray([t[4] for t in transitions], dtype=np.bool_),
+                    )
 
         print(f'Preloaded data... Buffer size {self.size}.')
 
     def sample(self, batch_size):
         raise NotImplementedError("Implement the sample method")
 
+    @staticmethod
+    def _to_device(columns, device):
+        # Batches bound for the GPU are staged in pinned memory, so that the copies do not block the host
+        if device.type != 'cuda':
+            return tuple(torch.from_numpy(column) for column in columns)
+        return tuple(torch.from_numpy(column).pin_memory().to(device, non_blocking=True) for column in columns)
+
+    def sample_tensors(self, batch_size, device):
+        """Same as sample, but returns the batch as torch tensors on the given device."""
+        return self._to_device(self.sample(batch_size), device)
+
 
 class UniformExperienceReplay(ExperienceReplay):
     def __init__(self, max_size=100000):
@@ -81,7 +169,7 @@ class UniformExperienceReplay(ExperienceReplay):
             batch_size = self.size
 
         indices = np.random.choice(self.size, size=batch_size, replace=False)
-        return self._transitions[indices, :]
+        return self._get_transitions(indices)
 
 
 class PrioritizedExperienceReplay(ExperienceReplay):
@@ -90,56 +178,73 @@ class PrioritizedExperienceReplay(ExperienceReplay):
         self._alpha = alpha
         self._beta = beta
         self._max_priority = 1.0
+        # New transitions are inserted with the max priority, its power is cached for add_transition
+        self._max_priority_alpha = self._max_priority ** self._alpha
 
-        st_capacity = 1
-        while st_capacity < max_size:
-            st_capacity *= 2
+        # The segment trees are 16-ary, so the capacity only has to be padded to a multiple of 16
+        st_capacity = -(-max_size // 16) * 16
         self._st_sum = SumSegmentTree(st_capacity)
         self._st_min = MinSegmentTree(st_capacity)
 
+    def __setstate__(self, state):
+        super(PrioritizedExperienceReplay, self).__setstate__(state)
+        # Buffers pickled before the max priority power was cached do not hold it yet
+        if '_max_priority_alpha' not in self.__dict__:
+            self._max_priority_alpha = self._max_priority ** self._alpha
+
     def add_transition(self, transitions_new):
         idx = self._current_idx
         super(PrioritizedExperienceReplay, self).add_transition(transitions_new)
-        self._st_min[idx] = self._max_priority ** self._alpha
-        self._st_sum[idx] = self._max_priority ** self._alpha
+        self._st_min[idx] = self._max_priority_alpha
+        self._st_sum[idx] = self._max_priority_alpha
+
+    def _insert_columns(self, columns):
+        indices = super(PrioritizedExperienceReplay, self)._insert_columns(columns)
+        self._st_min.update_batch(indices, self._max_priority_alpha)
+        self._st_sum.update_batch(indices, self._max_priority_alpha)
+        return indices
 
     def _sample_proportionally(self, batch_size):
-        indices = []
         p_total = self._st_sum.sum(0, self.size - 1)
         every_range_len = p_total / batch_size
-        for i in range(batch_size):
-            mass = np.random.uniform(0, 1) * every_range_len + i * every_range_len
-            idx = self._st_sum.find_prefixsum_idx(mass)
-            indices.append(idx)
-        return np.array(indices)
+        masses = (np.random.uniform(size=batch_size) + np.arange(batch_size)) * every_range_len
+        return self._st_sum.find_prefixsum_idx(masses)
 
     def sample(self, batch_size):
         if batch_size > self.size:
             batch_size = self.size
         indices = self._sample_proportionally(batch_size)
-        weights = []
+
+        p_total = self._st_sum.sum()
 
         # obtain the min probability (max weight accordingly) to scale the other weights (for stability)
-        p_min = self._st_min.min() / self._st_sum.sum()
+        p_min = self._st_min.min() / p_total
         max_weight = (p_min * self.size) ** (-self._beta)
 
-        for idx in indices:
-            # compute probability P(i)
-            p_sample = self._st_sum[idx] / self._st_sum.sum()
-            weight = (p_sample * self.size) ** (-self._beta)
-            weights.append(weight / max_weight)
+        # compute probabilities P(i)
+        p_sample = self._st_sum[indices] / p_total
+        weights = (p_sample * self.size) ** (-self._beta)
+        weights /= max_weight
 
-        return np.concatenate([self._transitions[indices, :], np.array(weights).reshape(-1, 1),
-                               indices.reshape(-1, 1)], axis=-1)
+        return self._get_transitions(indices), weights, indices
 
-    def update_priorities(self, indices, priorities):
-        for idx, priority in zip(indices, priorities):
-            assert priority > 0
-            assert 0 <= idx < self.size
-            self._st_sum[idx] = priority ** self._alpha
-            self._st_min[idx] = priority ** self._alpha
+    def sample_tensors(self, batch_size, device):
+        transitions, weights, indices = self.sample(batch_size)
+        return self._to_device(transitions, device), weights, indices
 
-            self._max_priority = max(self._max_priority, priority)
+    def update_priorities(self, indices, priorities):
+        indices = np.asarray(indices)
+        priorities = np.asarray(priorities, dtype=np.float64)
+        assert (priorities > 0).all()
+        assert ((0 <= indices) & (indices < self.size)).all()
+
+        p_alpha = priorities ** self._alpha
+        self._st_sum.update_batch(indices, p_alpha)
+        self._st_min.update_batch(indices, p_alpha)
+
+        if priorities.max() > self._max_priority:
+            self._max_priority = priorities.max()
+            self._max_priority_alpha = self._max_priority ** self._alpha
 
     def update_beta(self, beta):
         self._beta = beta
@@ -1,53 +1,98 @@
-import operator
+import numpy as np
+
+from .segment_tree_numba import NUMBA_AVAILABLE, st_update, st_update_batch, st_find_prefixsum_idx_batch
 
 """
-This file is borrowed from https://github.com/openai/baselines/blob/master/baselines/common/segment_tree.py
+This file is adapted from https://github.com/openai/baselines/blob/master/baselines/common/segment_tree.py
 All rights go to OpenAI.
+The binary tree is replaced by a b-ary tree stored level by level in a single flat array.
 """
 
+# Python reductions of the common operations, a group of children is reduced faster as a list than as an array slice
+_PY_REDUCE = {np.add: sum, np.minimum: min}
+
+
+def _aligned_empty(n, dtype, align=64):
+    """Returns an uninitialized array of n elements whose data starts at an `align` byte boundary."""
+    nbytes = n * np.dtype(dtype).itemsize
+    buf = np.empty(nbytes + align, dtype=np.uint8)
+    offset = (-buf.ctypes.data) % align
+    return buf[offset:offset + nbytes].view(dtype)
+
 
 class SegmentTree(object):
-    def __init__(self, capacity, operation, neutral_element):
-        """Build a Segment Tree data structure.
+    def __init__(self, capacity, operation, neutral_element, fanout=16):
+        """Build a b-ary Segment Tree data structure.
         https://en.wikipedia.org/wiki/Segment_tree
         Can be used as regular array, but with two
         important differences:
             a) setting item's value is slightly slower.
-               It is O(lg capacity) instead of O(1).
+               It is O(log_b capacity) instead of O(1).
             b) user has access to an efficient ( O(log segment size) )
                `reduce` operation which reduces `operation` over
                a contiguous subsequence of items in the array.
+        Every node holds the reduction of its `fanout` children, which lie
+        next to each other in memory, so one level of the tree is processed
+        with a single vectorized operation over a group of children.
         Paramters
         ---------
         capacity: int
-            Total size of the array - must be a power of two.
-        operation: lambda obj, obj -> obj
-            and operation for combining elements (eg. sum, max)
+            Total size of the array.
+        operation: np.ufunc
+            and operation for combining elements (eg. np.add, np.minimum)
             must form a mathematical group together with the set of
             possible values for array elements (i.e. be associative)
         neutral_element: obj
             neutral element for the operation above. eg. float('-inf')
             for max and 0 for sum.
+        fanout: int
+            number of children of every internal node.
         """
-        assert capacity > 0 and capacity & (capacity - 1) == 0, "capacity must be positive and a power of 2."
+        assert capacity > 0, "capacity must be positive."
         self._capacity = capacity
-        self._value = [neutral_element for _ in range(2 * capacity)]
+        self._fanout = fanout
         self._operation = operation
+        self._neutral_element = neutral_element
+
+        # Level sizes from the leaves up to the root, every level (the root too) is padded to a multiple of fanout
+        n_nodes = capacity
+        level_sizes = [self._pad(n_nodes)]
+        while n_nodes > 1:
+            n_nodes = self._pad(n_nodes) // fanout
+            level_sizes.append(self._pad(n_nodes))
+
+        # The levels are laid out in level order, i.e. the root comes first and the leaves last. With the padding
+        # and the 64 byte aligned storage every group of children starts at a cache line boundary.
+        self._depth = len(level_sizes) - 1
+        self._offsets = [sum(level_sizes[level + 1:]) for level in range(self._depth + 1)]
+        self._value = _aligned_empty(sum(level_sizes), np.float64)
+        self._value.fill(neutral_element)
+        self._offsets_arr = np.asarray(self._offsets, dtype=np.int64)
+        self._use_numba = NUMBA_AVAILABLE and operation in (np.add, np.minimum)
+
+    def __setstate__(self, state):
+        if '_offsets' not in state:
+            # Trees pickled before the b-ary layout are binary heaps, whose leaves are the second half of _value.
+            # The subclass rebuilds its empty tree from the capacity, the leaves are then written in one batch.
+            capacity = state['_capacity']
+            self.__init__(capacity)
+            self.update_batch(np.arange(capacity), state['_value'][capacity:])
+            return
 
-    def _reduce_helper(self, start, end, node, node_start, node_end):
-        if start == node_start and end == node_end:
-            return self._value[node]
-        mid = (node_start + node_end) // 2
-        if end <= mid:
-            return self._reduce_helper(start, end, 2 * node, node_start, mid)
-        else:
-            if mid + 1 <= start:
-                return self._reduce_helper(start, end, 2 * node + 1, mid + 1, node_end)
-            else:
-                return self._operation(
-                    self._reduce_helper(start, mid, 2 * node, node_start, mid),
-                    self._reduce_helper(mid + 1, end, 2 * node + 1, mid + 1, node_end)
-                )
+        # Unpickled arrays are not guaranteed to be aligned, copy the nodes back into aligned storage
+        self.__dict__.update(state)
+        value = _aligned_empty(len(self._value), np.float64)
+        value[:] = self._value
+        self._value = value
+
+    def _pad(self, n):
+        return -(-n // self._fanout) * self._fanout
+
+    def _reduce_slice(self, level, start, end):
+        if start >= end:
+            return self._neutral_element
+        offset = self._offsets[level]
+        return self._operation.reduce(self._value[offset + start:offset + end])
 
     def reduce(self, start=0, end=None):
         """Returns result of applying `self.operation`
@@ -68,31 +113,69 @@ class SegmentTree(object):
             end = self._capacity
         if end < 0:
             end += self._capacity
-        end -= 1
-        return self._reduce_helper(start, end, 1, 0, self._capacity - 1)
+        if start == 0 and end == self._capacity:
+            return self._value[0]
+
+        # Reduce the partial groups at both ends of the range, then continue with the whole groups one level up
+        result = self._neutral_element
+        lo, hi = start, end
+        for level in range(self._depth + 1):
+            if lo >= hi:
+                break
+            lo_group_end = min(self._pad(lo), hi)
+            result = self._operation(result, self._reduce_slice(level, lo, lo_group_end))
+            if lo_group_end == hi:
+                break
+            hi_group_start = max(hi // self._fanout * self._fanout, lo_group_end)
+            result = self._operation(result, self._reduce_slice(level, hi_group_start, hi))
+            lo, hi = lo_group_end // self._fanout, hi_group_start // self._fanout
+        return result
 
     def __setitem__(self, idx, val):
+        if self._use_numba:
+            st_update(self._value, self._offsets_arr, self._fanout, idx, val, self._operation is np.minimum)
+            return
+
+        value, offsets, fanout = self._value, self._offsets, self._fanout
+        reduce_children = _PY_REDUCE.get(self._operation, self._operation.reduce)
         # index of the leaf
-        idx += self._capacity
-        self._value[idx] = val
-        idx //= 2
-        while idx >= 1:
-            self._value[idx] = self._operation(
-                self._value[2 * idx],
-                self._value[2 * idx + 1]
-            )
-            idx //= 2
+        value[offsets[0] + idx] = val
+        for level in range(1, self._depth + 1):
+            idx //= fanout
+            start = offsets[level - 1] + idx * fanout
+            acc = reduce_children(value[start:start + fanout].tolist())
+            pos = offsets[level] + idx
+            # The nodes above only depend on this one, so they are up to date if it did not change
+            if value[pos] == acc:
+                break
+            value[pos] = acc
+
+    def update_batch(self, indices, values):
+        """Sets arr[indices[k]] = values[k] for the whole batch and updates the affected nodes once."""
+        indices = np.asarray(indices, dtype=np.int64).ravel()
+        values = np.broadcast_to(np.asarray(values, dtype=np.float64), indices.shape)
+        if self._use_numba:
+            st_update_batch(self._value, self._offsets_arr, self._fanout, indices, np.ascontiguousarray(values),
+                            self._operation is np.minimum)
+            return
+
+        self._value[self._offsets[0] + indices] = values
+        children_range = np.arange(self._fanout)
+        for level in range(1, self._depth + 1):
+            indices = np.unique(indices // self._fanout)
+            children = self._value[self._offsets[level - 1] + (indices * self._fanout)[:, None] + children_range]
+            self._value[self._offsets[level] + indices] = self._operation.reduce(children, axis=-1)
 
     def __getitem__(self, idx):
-        assert 0 <= idx < self._capacity
-        return self._value[self._capacity + idx]
+        assert np.all((0 <= idx) & (idx < self._capacity))
+        return self._value[self._offsets[0] + np.asarray(idx)]
 
 
 class SumSegmentTree(SegmentTree):
     def __init__(self, capacity):
         super(SumSegmentTree, self).__init__(
             capacity=capacity,
-            operation=operator.add,
+            operation=np.add,
             neutral_element=0.0
         )
 
@@ -108,29 +191,36 @@ class SumSegmentTree(SegmentTree):
         probability efficiently.
         Parameters_max_priority
         ----------
-        perfixsum: float
-            upperbound on the sum of array prefix
+        perfixsum: float or np.ndarray
+            upperbound on the sum of array prefix, a batch of upperbounds
+            is searched for at once by descending the tree level by level
         Returns
         -------
-        idx: int
+        idx: int or np.ndarray
             highest index satisfying the prefixsum constraint
         """
-        assert 0 <= prefixsum <= self.sum() + 1e-5
-        idx = 1
-        while idx < self._capacity:  # while non-leaf
-            if self._value[2 * idx] > prefixsum:
-                idx = 2 * idx
-            else:
-                prefixsum -= self._value[2 * idx]
-                idx = 2 * idx + 1
-        return idx - self._capacity
+        prefixsum = np.array(prefixsum, dtype=np.float64)
+        assert np.all((0 <= prefixsum) & (prefixsum <= self.sum() + 1e-5))
+        if self._use_numba:
+            idx = st_find_prefixsum_idx_batch(self._value, self._offsets_arr, self._fanout, prefixsum.ravel())
+            return idx.reshape(prefixsum.shape) if prefixsum.ndim else int(idx[0])
+
+        idx = np.zeros(prefixsum.shape, dtype=np.int64)
+        children_range = np.arange(self._fanout)
+        for level in range(self._depth - 1, -1, -1):  # descend all non-leaf levels
+            children = self._value[self._offsets[level] + (idx * self._fanout)[..., None] + children_range]
+            cumsum = np.cumsum(children, axis=-1)
+            child = np.minimum((cumsum <= prefixsum[..., None]).sum(axis=-1), self._fanout - 1)
+            prefixsum = prefixsum - np.take_along_axis(cumsum - children, child[..., None], axis=-1)[..., 0]
+            idx = idx * self._fanout + child
+        return idx if idx.ndim else int(idx)
 
 
 class MinSegmentTree(SegmentTree):
     def __init__(self, capacity):
         super(MinSegmentTree, self).__init__(
             capacity=capacity,
-            operation=min,
+            operation=np.minimum,
             neutral_element=float('inf')
         )
 
@@ -0,0 +1,57 @@
+import numpy as np
+
+"""
+Numba kernels for the b-ary segment trees in segment_tree.py.
+The tree is given as the flat node array together with the offsets of its levels, leaves first.
+If numba is not installed, NUMBA_AVAILABLE is False and the segment trees fall back to NumPy.
+"""
+
+try:
+    from numba import njit
+    NUMBA_AVAILABLE = True
+except ImportError:
+    NUMBA_AVAILABLE = False
+
+    def njit(*args, **kwargs):
+        return lambda f: f
+
+
+@njit(cache=True)
+def st_update(tree, offsets, fanout, idx, val, use_min):
+    depth = offsets.shape[0] - 1
+    # index of the leaf
+    tree[offsets[0] + idx] = val
+    for level in range(1, depth + 1):
+        idx //= fanout
+        start = offsets[level - 1] + idx * fanout
+        acc = tree[start]
+        for child in range(1, fanout):
+            if use_min:
+                acc = min(acc, tree[start + child])
+            else:
+                acc += tree[start + child]
+        tree[offsets[level] + idx] = acc
+
+
+@njit(cache=True)
+def st_update_batch(tree, offsets, fanout, indices, values, use_min):
+    for k in range(indices.shape[0]):
+        st_update(tree, offsets, fanout, indices[k], values[k], use_min)
+
+
+@njit(cache=True)
+def st_find_prefixsum_idx_batch(tree, offsets, fanout, prefixsums):
+    depth = offsets.shape[0] - 1
+    out = np.empty(prefixsums.shape[0], dtype=np.int64)
+    for k in range(prefixsums.shape[0]):
+        mass = prefixsums[k]
+        idx = 0
+        for level in range(depth - 1, -1, -1):
+            start = offsets[level] + idx * fanout
+            child = 0
+            while child < fanout - 1 and tree[start + child] <= mass:
+                mass -= tree[start + child]
+                child += 1
+            idx = idx * fanout + child
+        out[k] = idx
+    return out
@@ -8,17 +8,62 @@ import torch
 import math
 import torch.nn as nn
 import torch.nn.functional as F
-from torch.distributions import Normal
 from base.network import Feedforward
 from torch.autograd import Variable
 import torch.nn.init as init
 import numpy as np
+from collections import defaultdict
+
+
+class TwinLinear(nn.Module):
+    """
+    Two independent linear layers, stacked along the first dimension so that both run as one batched matmul.
+    The input and the output are of shape (2, batch_size, features).
+    """
+
+    def __init__(self, in_features, out_features):
+        super(TwinLinear, self).__init__()
+        self.weight = nn.Parameter(torch.empty(2, out_features, in_features))
+        self.bias = nn.Parameter(torch.empty(2, out_features))
+
+    def forward(self, x):
+        return torch.baddbmm(self.bias.unsqueeze(1), x, self.weight.transpose(1, 2))
 
 
 def weights_init_(m):
     if isinstance(m, nn.Linear):
         nn.init.xavier_uniform_(m.weight, gain=1)
         nn.init.constant_(m.bias, 0)
+    elif isinstance(m, TwinLinear):
+        # Every twin is initialized like a separate nn.Linear
+        for w in m.weight.data:
+            nn.init.xavier_uniform_(w, gain=1)
+        nn.init.constant_(m.bias, 0)
+
+
+def squashed_gaussian_sample(mu, log_sigma, action_scale, action_bias, log_action_scale_sum):
+    # torch.distributions.Normal is written out by hand, so that the pointwise ops can be fused by torch.compile
+    sigma = log_sigma.exp()
+    eps = torch.randn_like(mu)
+
+    x = mu + sigma * eps
+    y = torch.tanh(x)
+
+    # Reparametrization
+    action = y * action_scale + action_bias
+
+    log_prob = -0.5 * eps.pow(2) - log_sigma - 0.5 * math.log(2 * math.pi)
+
+    # log(1 - tanh(x)^2) in the numerically stable form 2 * (log(2) - x - softplus(-2x))
+    log_prob = log_prob - 2. * (math.log(2.) - x - F.softplus(-2. * x))
+    log_prob = log_prob.sum(axis=1, keepdim=True) - log_action_scale_sum
+    mu = torch.tanh(mu) * action_scale + action_bias
+
+    return action, log_prob, mu, sigma
+
+
+if hasattr(torch, 'compile'):
+    squashed_gaussian_sample = torch.compile(squashed_gaussian_sample, dynamic=False)
 
 
 class CriticNetwork(nn.Module):
@@ -27,8 +72,11 @@ class CriticNetwork(nn.Module):
         self.device = device
         layer_sizes = [input_dim[0] + n_actions] + hidden_sizes + [1]
 
-        self.q1_layers = nn.ModuleList([nn.Linear(i, o) for i, o in zip(layer_sizes[:-1], layer_sizes[1:])])
-        self.q2_layers = nn.ModuleList([nn.Linear(i, o) for i, o in zip(layer_sizes[:-1], layer_sizes[1:])])
+        # Q1 and Q2 are evaluated together, every TwinLinear holds the layer of both twins
+        layers = []
+        for i, o in zip(layer_sizes[:-2], layer_sizes[1:-1]):
+            layers += [TwinLinear(i, o), nn.ReLU(inplace=True)]
+        self.q = nn.Sequential(*layers, TwinLinear(layer_sizes[-2], layer_sizes[-1]))
 
         self.apply(weights_init_)
 
@@ -49,17 +97,39 @@ class CriticNetwork(nn.Module):
     def forward(self, state, action):
         xu = torch.cat([state, action], 1)
 
-        x1 = xu
-        for l in self.q1_layers[:-1]:
-            x1 = F.relu(l(x1))
-        x1 = self.q1_layers[-1](x1)
-
-        x2 = xu
-        for l in self.q2_layers[:-1]:
-            x2 = F.relu(l(x2))
-        x2 = self.q2_layers[-1](x2)
-
-        return x1, x2
+        with torch.autocast(device_type=self.device.type, dtype=torch.bfloat16, enabled=self.device.type == 'cuda'):
+            x = self.q(xu.unsqueeze(0).expand(2, -1, -1))
+
+        x = x.float()
+        return x[0], x[1]
+
+    def __setstate__(self, state):
+        super(CriticNetwork, self).__setstate__(state)
+        if 'q1_layers' in self._modules:
+            self._migrate_twin_layers()
+
+    def _migrate_twin_layers(self):
+        # Critics pickled before the twins were fused hold them as two lists of nn.Linear layers.
+        # Their weights and Adam moments are stacked into TwinLinear layers, which the optimizer then holds.
+        q1_layers, q2_layers = self._modules.pop('q1_layers'), self._modules.pop('q2_layers')
+        old_state = self.optimizer.state
+
+        layers, moments = [], {}
+        for l1, l2 in zip(q1_layers, q2_layers):
+            twin = TwinLinear(l1.in_features, l1.out_features).to(l1.weight.device)
+            for name in ['weight', 'bias']:
+                p1, p2 = getattr(l1, name), getattr(l2, name)
+                getattr(twin, name).data.copy_(torch.stack([p1.data, p2.data]))
+                if p1 in old_state and p2 in old_state:
+                    moments[getattr(twin, name)] = {
+                        k: torch.stack([v, old_state[p2][k]]) if k in ['exp_avg', 'exp_avg_sq'] else v
+                        for k, v in old_state[p1].items()
+                    }
+            layers += [twin, nn.ReLU(inplace=True)]
+        self.q = nn.Sequential(*layers[:-1])
+
+        self.optimizer.param_groups[0]['params'] = list(self.parameters())
+        self.optimizer.state = defaultdict(dict, moments)
 
 class ActorNetwork(Feedforward):
     def __init__(self, input_dims, learning_rate, device, lr_milestones, lr_factor=0.5,
@@ -71,7 +141,7 @@ class ActorNetwork(Feedforward):
             device=device
         )
 
-        self.reparam_noise = reparam_noise
+        # reparam_noise is only accepted for compatibility, the stable form of the tanh correction does not need it
         self.action_space = action_space
         n_actions = action_dim
 
@@ -96,43 +166,32 @@ class ActorNetwork(Feedforward):
             self.action_scale = torch.tensor(1.).to(self.device)
             self.action_bias = torch.tensor(0.).to(self.device)
 
+        # The action scale is constant, so its part of the tanh correction is computed once
+        self.log_action_scale_sum = torch.log(self.action_scale * torch.ones(n_actions, device=self.device)).sum()
+
     def forward(self, state):
-        prob = state
-        for layer in self.layers:
-            prob = F.relu(layer(prob))
+        with torch.autocast(device_type=self.device.type, dtype=torch.bfloat16, enabled=self.device.type == 'cuda'):
+            prob = state
+            for layer in self.layers:
+                prob = F.relu(layer(prob))
 
-        mu = self.mu(prob)
-        log_sigma = self.log_sigma(prob)
-        log_sigma = torch.clamp(log_sigma, min=-20, max=10)
+            mu = self.mu(prob)
+            log_sigma = self.log_sigma(prob)
+
+        # The sampling math runs in float32 for numerical safety
+        mu = mu.float()
+        log_sigma = torch.clamp(log_sigma.float(), min=-20, max=10)
 
         return mu, log_sigma
 
+    def __setstate__(self, state):
+        super(ActorNetwork, self).__setstate__(state)
+        # Actors pickled before the tanh correction was precomputed do not hold it yet
+        if 'log_action_scale_sum' not in self.__dict__:
+            self.log_action_scale_sum = torch.log(
+                self.action_scale * torch.ones(self.mu.out_features, device=self.device)
+            ).sum()
+
     def sample(self, state):
         mu, log_sigma = self.forward(state)
-        sigma = log_sigma.exp()
-        normal = Normal(mu, sigma)
-
-        x = normal.rsample()
-        y = torch.tanh(x)
-
-        # Reparametrization
-        action = y * self.action_scale + self.action_bias
-
-        log_prob = normal.log_prob(x)
-
-        log_prob -= torch.log(self.action_scale * (1 - y.pow(2)) + self.reparam_noise)
-        log_prob = log_prob.sum(axis=1, keepdim=True)
-        mu = torch.tanh(mu) * self.action_scale + self.action_bias
-
-        return action, log_prob, mu, sigma
-
-
-
-
-
-
-
-	
-
-
-
+        return squashed_gaussian_sample(mu, log_sigma, self.action_scale, self.action_bias, self.log_action_scale_sum)
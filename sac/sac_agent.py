@@ -57,6 +57,8 @@ class SACAgent():
 
         self.action_space = action_space
         self.device = args.device
+        self._copy_stream = None
+        self._prefetched = None
         self.alpha = args.alpha
         self.automatic_entropy_tuning = self.args.automatic_entropy_tuning
         self.eval_mode = False
@@ -182,6 +184,8 @@ class SACAgent():
         self.critic = copy.deepcopy(agent.critic)
         self.critic_target = copy.deepcopy(agent.critic_target)
         self.buffer =  copy.deepcopy(agent.buffer)
+        # A batch prefetched from the replaced buffer must not be trained on
+        self._prefetched = None
         if keep_args:
             self.args = agent.args
 
@@ -195,6 +199,8 @@ class SACAgent():
         if len(transition)>6:
             NotImplementedError('Does not accept extra data dimensions')
         self.buffer.add_transition(transition)
+        # A batch prefetched before this transition was stored would miss it, so it is sampled anew
+        self._prefetched = None
 
     def eval(self):
         self.eval_mode = True
@@ -207,6 +213,15 @@ class SACAgent():
             return self._act(obs, phase=phase, evaluate=True) if self.eval_mode else self._act(obs, phase=phase)
         return self._act(obs, evaluate=True) if self.eval_mode else self._act(obs)
 
+    def act_batch(self, obs, phase=None):
+        # Acts on a batch of observations, e.g. one from each of several parallel environments
+        state = torch.Tensor(np.asarray(obs)).to(self.args.device)
+        if self.args.phased:
+            action, _, mu, _ = self.actor.sample(state, phase=phase)
+        else:
+            action, _, mu, _ = self.actor.sample(state)
+        return (mu if self.eval_mode else action).detach().cpu().numpy()
+
     def _act(self, obs, evaluate=False, phase=None):
         # if isinstance(obs, tuple):
         #     obs = obs[0]
@@ -227,50 +242,53 @@ class SACAgent():
         self.critic.lr_scheduler.step()
         self.actor.lr_scheduler.step()
 
-    def update_parameters(self, total_step):
-        data = self.buffer.sample(self.args.batch_size)
-        if self.args.phased:
-            if data.shape[1] > 6:
-                phase = torch.tensor( 
-                    np.stack(data[:, 5]),
-                    device=self.device,
-                    dtype=torch.float
-                )
-                next_phase = torch.tensor(
-                    np.stack(data[:, 6]),
-                    device=self.device,
-                    dtype=torch.float
-                )
-        
-        state = torch.tensor(
-            np.stack(data[:, 0]),
-            device=self.device,
-            dtype=torch.float
-        )
+    def __getstate__(self):
+        # The CUDA stream cannot be pickled and the prefetched batch is stale after loading
+        state = self.__dict__.copy()
+        state['_copy_stream'] = None
+        state['_prefetched'] = None
+        return state
 
-        next_state = torch.tensor(
-            np.stack(data[:, 3]),
-            device=self.device,
-            dtype=torch.float
-        )
+    def _sample_tensors(self):
+        if self.args.per:
+            data, _, _ = self.buffer.sample_tensors(self.args.batch_size, self.device)
+            return data
+        return self.buffer.sample_tensors(self.args.batch_size, self.device)
+
+    def _sample_batch(self):
+        # On CUDA the next batch is copied on a side stream while the current one is trained on
+        if self.device.type != 'cuda':
+            return self._sample_tensors()
+
+        if getattr(self, '_copy_stream', None) is None:
+            self._copy_stream = torch.cuda.Stream(self.device)
+            self._prefetched = None
+        if self._prefetched is None:
+            with torch.cuda.stream(self._copy_stream):
+                self._prefetched = self._sample_tensors()
+
+        current_stream = torch.cuda.current_stream(self.device)
+        current_stream.wait_stream(self._copy_stream)
+        data = self._prefetched
+        for t in data:
+            t.record_stream(current_stream)
+
+        with torch.cuda.stream(self._copy_stream):
+            self._prefetched = self._sample_tensors()
+        return data
 
-        action = torch.tensor(
-            np.stack(data[:, 1])[:, None],
-            device=self.device,
-            dtype=torch.float
-        ).squeeze(dim=1)
-
-        reward = torch.tensor(
-            np.stack(data[:, 2])[:, None],
-            device=self.device,
-            dtype=torch.float
-        ).squeeze(dim=1)
-
-        not_done = torch.tensor(
-            (~np.stack(data[:, 4])[:, None]).astype(int),
-            device=self.device,
-            dtype=torch.float
-        ).squeeze(dim=1)
+    def update_parameters(self, total_step):
+        data = self._sample_batch()
+        if self.args.phased:
+            if len(data) > 6:
+                phase = data[5]
+                next_phase = data[6]
+
+        state = data[0]
+        action = data[1]
+        reward = data[2]
+        next_state = data[3]
+        not_done = (~data[4]).float()
 
         with torch.no_grad():
             if self.args.phased:
@@ -31,6 +31,7 @@ parser.add_argument('--transitions_path', help='Path to the root of folder conta
 parser.add_argument('--max_episodes', help='Max episodes for training', type=int, default=5000)
 parser.add_argument('--max_steps', help='Max steps for training', type=int, default=250)
 parser.add_argument('--eval_episodes', help='Set number of evaluation episodes', type=int, default=30)
+parser.add_argument('--eval_envs', help='# of environments played at the same time during evaluation, stepped sequentially with batched agent actions', type=int, default=1)
 parser.add_argument('--evaluate_every',
                     help='# of episodes between evaluating agent during the training', type=int, default=1000)
 parser.add_argument('--add_self_every',
@@ -243,7 +243,8 @@ class SACTrainer:
                         env,
                         ev_opponent,
                         100,
-                        quiet=True
+                        quiet=True,
+                        n_envs=self.args.eval_envs
                     )
                     eval_stats[eval_op]['reward'].append(rew)
                     eval_stats[eval_op]['touch'].append(touch)
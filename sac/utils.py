@@ -25,25 +25,20 @@ def kn(p, n):
     
 
 def compute_multipliers(w,p):
-    list_of_w = []
-    for n in range(4):
-        list_of_w.append(torch.zeros(p.shape).to(p.device))
     w2 = torch.pow(w,2)
     w3 = torch.pow(w,3)
 
-    for n in range(4):
-        ind = kn(p,n)
-        if n == 0:
-            weight = w2 - 0.5*w - 0.5*w3 
-        elif n == 1:
-            weight = 1 - 2.5*w2 + 1.5*w3
-        elif n == 2:
-            weight = 0.5*w + 2*w2 - 1.5*w3
-        elif n == 3:
-            weight = 0.5*(w3 - w2)
-        for j in range(len(ind)):
-            #list_of_w[ind[j]][j] = weight[j,0]
-            list_of_w[ind[j]][j] = weight[j]
+    # Catmull-Rom weights of the 4 control points, scattered to the control point indices kn(p, n)
+    weights = torch.stack([
+        w2 - 0.5*w - 0.5*w3,
+        1 - 2.5*w2 + 1.5*w3,
+        0.5*w + 2*w2 - 1.5*w3,
+        0.5*(w3 - w2),
+    ], dim=0)
+    offsets = torch.arange(-1, 3, device=p.device).view(-1, *([1] * p.dim()))
+    ind = (torch.floor((4*p)/(2*math.pi)).long() + offsets) % 4
+
+    list_of_w = torch.zeros_like(weights).scatter_(0, ind, weights)
 
     return list_of_w[0], list_of_w[1], list_of_w[2], list_of_w[3]
 
@@ -57,16 +52,22 @@ def running_mean(x, N):
     return (cumsum[N:] - cumsum[:-N]) / float(N)
 
 
+@torch.no_grad()
 def soft_update(target, source, tau):
-    for target_param, param in zip(target.parameters(), source.parameters()):
-        target_param.data.copy_(
-            target_param.data * (1.0 - tau) + param.data * tau
-        )
+    # The _foreach ops update all parameters with one kernel launch instead of one per tensor
+    target_params = list(target.parameters())
+    torch._foreach_mul_(target_params, 1.0 - tau)
+    torch._foreach_add_(target_params, list(source.parameters()), alpha=tau)
 
 
+@torch.no_grad()
 def hard_update(target, source):
-    for target_param, param in zip(target.parameters(), source.parameters()):
-        target_param.data.copy_(param.data)
+    target_params, source_params = list(target.parameters()), list(source.parameters())
+    if hasattr(torch, '_foreach_copy_'):
+        torch._foreach_copy_(target_params, source_params)
+    else:
+        for target_param, param in zip(target_params, source_params):
+            target_param.copy_(param)
 
 
 def poll_opponent(opponents):
@@ -253,12 +254,17 @@ class Logger:
 
             print(msg_string)
 
+    @staticmethod
+    def _mean(stats):
+        # Stats are either dicts keyed by episode or arrays with one entry per episode
+        return np.mean(list(stats.values()) if isinstance(stats, dict) else stats)
+
     def print_stats(self, rew_stats, touch_stats, won_stats, lost_stats):
         if not self.quiet:
             print(tabulate([['Mean reward', np.around(np.mean(rew_stats), 3)],
-                            ['Mean touch', np.around(np.mean(list(touch_stats.values())), 3)],
-                            ['Mean won', np.around(np.mean(list(won_stats.values())), 3)],
-                            ['Mean lost', np.around(np.mean(list(lost_stats.values())), 3)]], tablefmt='grid'))
+                            ['Mean touch', np.around(self._mean(touch_stats), 3)],
+                            ['Mean won', np.around(self._mean(won_stats), 3)],
+                            ['Mean lost', np.around(self._mean(lost_stats), 3)]], tablefmt='grid'))
 
     def load_model(self, filename):
         if filename is None: